@@ -0,0 +1,53 @@
+import logging
+from collections.abc import Sequence
+from typing import Any
+
+logger = logging.getLogger("n8n_agent")
+
+
+def context_messages(chat_ctx: Any) -> Sequence[Any]:
+    """Return the messages held by a ChatContext-like object, or []."""
+    # Try different ways to access messages based on ChatContext structure
+    if hasattr(chat_ctx, "messages"):
+        messages = chat_ctx.messages
+        # livekit-agents 1.x exposes messages() as a method, older code a list
+        return messages() if callable(messages) else messages
+    if hasattr(chat_ctx, "items"):
+        return chat_ctx.items
+    if hasattr(chat_ctx, "__iter__"):
+        return list(chat_ctx)
+    return []
+
+
+def extract_latest_user_text(chat_ctx: Any) -> str:
+    """Return the text of the most recent non-empty user message, or ""."""
+    messages = context_messages(chat_ctx)
+
+    logger.debug(f"[N8N] Found {len(messages)} messages in context")
+
+    # Walk backwards: the latest user turn is almost always near the end,
+    # so long histories are not scanned in full
+    for msg in reversed(messages):
+        if getattr(msg, "role", None) != "user":
+            continue
+
+        content = getattr(msg, "content", None)
+        text = ""
+        if isinstance(content, str):
+            text = content
+        elif isinstance(content, list):
+            # Handle list of content items
+            for item in content:
+                if isinstance(item, str):
+                    text = item
+                    break
+                elif hasattr(item, "text"):
+                    text = item.text
+                    break
+        elif hasattr(content, "text"):
+            text = content.text
+
+        if text:
+            return text
+
+    return ""
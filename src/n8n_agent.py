@@ -1,11 +1,14 @@
 import asyncio
-import json
+import hashlib
 import logging
 import os
+import secrets
+import time
 import uuid
-from typing import Optional, Dict, Any
+from typing import Any, Optional, Union
 
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 from livekit.agents import (
     NOT_GIVEN,
@@ -22,15 +25,17 @@ from livekit.agents import (
 )
 from livekit.agents.llm import (
     LLM,
-    LLMStream,
-    ChatContext,
     ChatChunk,
-    ChoiceDelta,
+    ChatContext,
     ChatMessage,
+    ChoiceDelta,
+    LLMStream,
 )
-from livekit.plugins import cartesia, deepgram, noise_cancellation, silero, elevenlabs
+from livekit.plugins import cartesia, deepgram, elevenlabs, noise_cancellation, silero
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 
+from message_extraction import context_messages, extract_latest_user_text
+
 logger = logging.getLogger("n8n_agent")
 
 load_dotenv(override=True)
@@ -40,18 +45,121 @@ load_dotenv(override=True)
 # ELEVENLABS_VOICE_ID = "UJCi4DDncuo0VJDSIegj" #Canadian French
 ELEVENLABS_VOICE_ID = "dYjOkSQBPiH2igolJfeH"
 
+# Transient gateway errors from n8n (or its proxy) that are worth retrying
+RETRY_STATUSES = frozenset({502, 503, 504})
+RETRY_START_DELAY = 0.1  # seconds; doubles on every retry
+
+# Upper bound on cached replies per LLM; the oldest entry is evicted first
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+# Spoken when the webhook answers without any usable text
+EMPTY_REPLY_TEXT = "I couldn't generate a response."
+
+# Webhook replies are read in bounded pieces and refused past this size
+RESPONSE_READ_CHUNK_BYTES = 8192
+MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+# Bytes of a non-200 body kept for the error log
+ERROR_BODY_LOG_BYTES = 1024
+
+
+class WebhookResponseTooLargeError(Exception):
+    """Raised when an n8n webhook reply exceeds MAX_RESPONSE_BYTES"""
+
 
 class N8nWebhookLLM(LLM):
     """Custom LLM that sends requests to n8n webhook instead of OpenAI"""
 
-    def __init__(self, webhook_url: str, webhook_token: str, timeout: float = 8.0):
+    def __init__(
+        self,
+        webhook_url: str,
+        webhook_token: str,
+        timeout: float = 8.0,
+        chunk_size: Optional[int] = None,
+        max_attempts: int = 3,
+        cache_ttl: Optional[float] = None,
+    ):
         super().__init__()
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError(
+                f"chunk_size must be a positive int or None, got {chunk_size}"
+            )
+        if max_attempts < 1:
+            # The retry loop would never run and leave no reply text
+            raise ValueError(f"max_attempts must be at least 1, got {max_attempts}")
         self.webhook_url = webhook_url
         self.webhook_token = webhook_token
         self.timeout = timeout
+        # Characters per emitted chunk; None emits the whole reply as one chunk
+        self.chunk_size = chunk_size
+        # Total tries per turn for RETRY_STATUSES responses (1 disables retries)
+        self.max_attempts = max_attempts
+        # Seconds to reuse the reply for an identical conversation history (e.g.
+        # the regenerated reply after a false interruption); None disables it
+        self.cache_ttl = cache_ttl
+        self._cache: dict[str, tuple[float, str]] = {}  # key -> (stored_at, text)
         self.session_id = str(uuid.uuid4())
         self.turn_counter = 0
         self._cursors = {}  # Track conversation cursors
+        # Built once from immutable config and shared by every turn's payload
+        self._base_context: dict[str, Any] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _ensure_session(self) -> aiohttp.ClientSession:
+        """Return the pooled HTTP session, creating it on first use"""
+        # One session per LLM so TCP/TLS handshakes are amortized across turns
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=32, ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    @staticmethod
+    def _cache_key(chat_ctx: ChatContext) -> str:
+        """Hash the whole conversation history a reply was generated for"""
+        # Keying on the latest utterance alone would replay the first answer
+        # to every repeated "yes" and hide those turns from the n8n agent
+        history = [
+            [getattr(msg, "role", None), getattr(msg, "content", None)]
+            for msg in context_messages(chat_ctx)
+        ]
+        return hashlib.sha256(orjson.dumps(history, default=str)).hexdigest()
+
+    def _cached_reply(self, chat_ctx: ChatContext) -> Optional[str]:
+        """Return a still-fresh cached reply for this history, if any"""
+        if self.cache_ttl is None:
+            return None
+        key = self._cache_key(chat_ctx)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, text = entry
+        if time.monotonic() - stored_at > self.cache_ttl:
+            del self._cache[key]
+            return None
+        return text
+
+    def _store_reply(self, chat_ctx: ChatContext, text: str) -> None:
+        """Remember a real reply for an identical future history"""
+        # Fallback text is not an answer from the workflow and must not stick
+        if self.cache_ttl is None or text == EMPTY_REPLY_TEXT:
+            return
+        if len(self._cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            # Dicts keep insertion order, so the first key is the oldest
+            del self._cache[next(iter(self._cache))]
+        self._cache[self._cache_key(chat_ctx)] = (time.monotonic(), text)
+
+    def clear_cache(self) -> None:
+        """Drop every cached reply"""
+        self._cache.clear()
+
+    async def aclose(self) -> None:
+        """Close the pooled HTTP session"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        await super().aclose()
 
     def chat(
         self,
@@ -76,56 +184,12 @@ class N8nWebhookLLM(LLM):
         )
 
         # Extract the latest user message
-        user_message = ""
         try:
-            # Try different ways to access messages based on ChatContext structure
-            messages = []
-
-            # Try messages property
-            if hasattr(chat_ctx, "messages"):
-                messages = chat_ctx.messages
-                logger.debug(f"[N8N] Found messages via .messages property")
-            # Try items property
-            elif hasattr(chat_ctx, "items"):
-                messages = chat_ctx.items
-                logger.debug(f"[N8N] Found messages via .items property")
-            # Try as iterable
-            elif hasattr(chat_ctx, "__iter__"):
-                messages = list(chat_ctx)
-                logger.debug(f"[N8N] Found messages via iteration")
-
-            logger.debug(f"[N8N] Found {len(messages)} messages in context")
-
-            # Extract the latest user message
-            for msg in reversed(messages):
-                logger.debug(
-                    f"[N8N] Message: role={getattr(msg, 'role', 'unknown')}, content type={type(getattr(msg, 'content', None))}"
+            user_message = extract_latest_user_text(chat_ctx)
+            if user_message:
+                logger.info(
+                    f"[N8N] Successfully extracted user message: {user_message}"
                 )
-
-                # Check if it's a user message
-                if hasattr(msg, "role") and msg.role == "user":
-                    content = getattr(msg, "content", None)
-
-                    if isinstance(content, str):
-                        user_message = content
-                    elif isinstance(content, list):
-                        # Handle list of content items
-                        for item in content:
-                            if isinstance(item, str):
-                                user_message = item
-                                break
-                            elif hasattr(item, "text"):
-                                user_message = item.text
-                                break
-                    elif hasattr(content, "text"):
-                        user_message = content.text
-
-                    if user_message:
-                        logger.info(
-                            f"[N8N] Successfully extracted user message: {user_message}"
-                        )
-                        break
-
         except Exception as e:
             logger.error(f"[N8N] Error extracting messages: {e}")
             import traceback
@@ -138,8 +202,10 @@ class N8nWebhookLLM(LLM):
             "session_id": self.session_id,
             "turn_id": f"t_{self.turn_counter}",
             "input": {"type": "text", "text": user_message},
-            "context": {},
-            "idempotency_key": str(uuid.uuid4()),
+            "context": self._base_context,
+            # 32 lowercase hex chars carrying 128 random bits (uuid4 has 122);
+            # not a hyphenated UUID, so consumers must not parse it as one
+            "idempotency_key": secrets.token_hex(16),
         }
 
         logger.info(f"[N8N] Creating stream with payload: {payload}")
@@ -200,8 +266,98 @@ class N8nLLMStream(LLMStream):
         """Required abstract method - delegates to _fetch_response"""
         await self._fetch_response()
 
-    async def _fetch_response(self):
-        """Fetch response from n8n webhook and emit chunks"""
+    @staticmethod
+    def _extract_output_text(data: Any) -> str:
+        """Extract the reply text from a parsed n8n response body.
+
+        Returns a fallback reply when the body carries no usable text.
+        """
+        if isinstance(data, dict):
+            # Try different keys that n8n might use
+            text = (
+                data.get("output")
+                or data.get("response")
+                or data.get("text")
+                or data.get("message")
+                or ""
+            )
+            # If text is still a dict, use its nested text or treat it as empty
+            if isinstance(text, dict):
+                text = text.get("text") or ""
+        elif isinstance(data, str):
+            text = data
+        else:
+            text = str(data)
+
+        return str(text) if text else EMPTY_REPLY_TEXT
+
+    @staticmethod
+    def _build_error_message(error: Union[int, BaseException]) -> str:
+        """Map a non-200 HTTP status or a request exception to a spoken reply"""
+        if isinstance(error, int):
+            return "I'm having trouble processing your request right now."
+        if (
+            isinstance(
+                error, (asyncio.TimeoutError, aiohttp.ServerTimeoutError, TimeoutError)
+            )
+            or "timeout" in str(error).lower()
+        ):
+            return "The request timed out. Please try again."
+        return "I encountered an error. Please try again."
+
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse) -> bytearray:
+        """Read the response body incrementally, refusing oversized replies
+
+        Raises:
+            WebhookResponseTooLargeError: body exceeds MAX_RESPONSE_BYTES
+        """
+        body = bytearray()
+        async for piece in response.content.iter_chunked(RESPONSE_READ_CHUNK_BYTES):
+            body.extend(piece)
+            if len(body) > MAX_RESPONSE_BYTES:
+                raise WebhookResponseTooLargeError(
+                    f"Webhook reply exceeded {MAX_RESPONSE_BYTES} bytes"
+                )
+        return body
+
+    async def _read_reply_text(self, response: aiohttp.ClientResponse) -> str:
+        """Turn a webhook HTTP response into the text the agent should say"""
+        encoding = response.charset or "utf-8"
+
+        if response.status != 200:
+            # Only a bounded prefix is needed for the log; the rest is dropped
+            # with the connection instead of being buffered
+            prefix = await response.content.read(ERROR_BODY_LOG_BYTES)
+            logger.error(
+                f"[N8N Stream] Webhook returned status {response.status}, "
+                f"body: {prefix.decode(encoding, errors='replace')}"
+            )
+            return self._build_error_message(response.status)
+
+        body = await self._read_body(response)
+
+        # Try to parse as JSON first, fall back to text
+        content_type = response.headers.get("content-type", "")
+
+        if "application/json" in content_type:
+            try:
+                data = orjson.loads(body)
+                logger.debug(f"[N8N Stream] Response data: {data}")
+            except orjson.JSONDecodeError:
+                # If JSON parsing fails, treat as text
+                data = body.decode(encoding, errors="replace")
+        else:
+            # Plain text response
+            data = body.decode(encoding, errors="replace")
+
+        text = self._extract_output_text(data)
+        logger.info(f"[N8N Stream] Extracted text: {text[:100]}...")
+        self._llm._store_reply(self._chat_ctx, text)
+        return text
+
+    async def _request_reply_text(self) -> str:
+        """POST the payload to the webhook and return the reply text"""
         logger.info(f"[N8N Stream] Starting webhook call to {self.webhook_url}")
         logger.debug(f"[N8N Stream] Payload: {self.payload}")
 
@@ -212,78 +368,63 @@ class N8nLLMStream(LLMStream):
             logger.debug("[N8N Stream] Added Bearer token to headers")
 
         try:
-            logger.debug("[N8N Stream] Creating aiohttp session...")
-            async with aiohttp.ClientSession() as session:
-                logger.info(f"[N8N Stream] Sending POST request to webhook...")
+            session = await self._llm._ensure_session()
+            loop = asyncio.get_running_loop()
+            # One budget for the whole turn, so slow gateway errors cannot
+            # stretch it to max_attempts * timeout plus backoff
+            deadline = loop.time() + self.timeout
+            for attempt in range(1, self._llm.max_attempts + 1):
+                logger.info(
+                    f"[N8N Stream] Sending POST request to webhook (attempt {attempt})..."
+                )
                 async with session.post(
                     self.webhook_url,
-                    json=self.payload,
+                    # orjson encodes straight to bytes; Content-Type is set above
+                    data=orjson.dumps(self.payload),
                     headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                    timeout=aiohttp.ClientTimeout(total=deadline - loop.time()),
+                    # Security: never forward the payload/token to a redirect target
+                    allow_redirects=False,
                 ) as response:
                     logger.info(
                         f"[N8N Stream] Received response: status={response.status}"
                     )
-                    if response.status == 200:
-                        # Try to parse as JSON first, fall back to text
-                        content_type = response.headers.get("content-type", "")
-
-                        if "application/json" in content_type:
-                            try:
-                                data = await response.json()
-                                logger.debug(f"[N8N Stream] Response data: {data}")
-                                # Extract response text from various possible formats
-                                if isinstance(data, dict):
-                                    # Try different keys that n8n might use
-                                    text = (
-                                        data.get("output")
-                                        or data.get("response")
-                                        or data.get("text")
-                                        or data.get("message")
-                                        or ""
-                                    )
-                                    # If text is still a dict, try to extract text or set as empty
-                                    if isinstance(text, dict):
-                                        nested_text = text.get("text", "")
-                                        # Only use string representation if there's actual content
-                                        if nested_text and nested_text != "":
-                                            text = nested_text
-                                        else:
-                                            text = ""
-                                elif isinstance(data, str):
-                                    text = data
-                                else:
-                                    text = str(data)
-                            except json.JSONDecodeError:
-                                # If JSON parsing fails, treat as text
-                                text = await response.text()
-                        else:
-                            # Plain text response
-                            text = await response.text()
-
-                        # Ensure we have a string
-                        text = str(text) if text else "I couldn't generate a response."
-                        logger.info(f"[N8N Stream] Extracted text: {text[:100]}...")
-                    else:
-                        body = await response.text()
-                        logger.error(
-                            f"[N8N Stream] Webhook returned status {response.status}, body: {body}"
-                        )
-                        text = "I'm having trouble processing your request right now."
+                    # Transient gateway error: back off exponentially, then retry
+                    delay = RETRY_START_DELAY * 2 ** (attempt - 1)
+                    should_retry = (
+                        response.status in RETRY_STATUSES
+                        and attempt < self._llm.max_attempts
+                        and delay < deadline - loop.time()
+                    )
+                    if not should_retry:
+                        text = await self._read_reply_text(response)
+
+                if not should_retry:
+                    break
+                logger.warning(
+                    f"[N8N Stream] Webhook returned {response.status}, retrying in {delay}s"
+                )
+                await asyncio.sleep(delay)
 
         except (asyncio.TimeoutError, aiohttp.ServerTimeoutError) as e:
             logger.error(f"[N8N Stream] Timeout after {self.timeout} seconds: {e}")
-            text = "The request timed out. Please try again."
+            text = self._build_error_message(e)
         except Exception as e:
             logger.error(f"[N8N Stream] Error calling webhook: {type(e).__name__}: {e}")
             import traceback
 
             logger.debug(f"[N8N Stream] Traceback: {traceback.format_exc()}")
-            # Check if it's a timeout-related error
-            if "timeout" in str(e).lower() or isinstance(e, TimeoutError):
-                text = "The request timed out. Please try again."
-            else:
-                text = "I encountered an error. Please try again."
+            text = self._build_error_message(e)
+
+        return text
+
+    async def _fetch_response(self):
+        """Fetch response from n8n webhook and emit chunks"""
+        text = self._llm._cached_reply(self._chat_ctx)
+        if text is not None:
+            logger.info("[N8N Stream] Serving cached reply")
+        else:
+            text = await self._request_reply_text()
 
         # Create complete message for the chat context
         logger.debug(f"[N8N Stream] Setting cursor with text: {text[:50]}...")
@@ -292,31 +433,42 @@ class N8nLLMStream(LLMStream):
             role="assistant", content=[text]
         )
 
-        # Emit response in chunks for smoother TTS
-        chunk_size = 50
-        num_chunks = (len(text) + chunk_size - 1) // chunk_size
-        logger.debug(
-            f"[N8N Stream] Chunking response into {num_chunks} chunks of {chunk_size} chars"
-        )
+        chunk_size = self._llm.chunk_size
+        if chunk_size is None or chunk_size >= len(text):
+            # The HTTP body already arrived whole: splitting it only adds
+            # allocations and scheduler trips
+            logger.debug("[N8N Stream] Sending response as a single chunk")
+            self._event_ch.send_nowait(
+                ChatChunk(
+                    id=str(uuid.uuid4()),
+                    delta=ChoiceDelta(role="assistant", content=text),
+                )
+            )
+        else:
+            # Emit response in chunks for smoother TTS
+            num_chunks = (len(text) + chunk_size - 1) // chunk_size
+            logger.debug(
+                f"[N8N Stream] Chunking response into {num_chunks} chunks of {chunk_size} chars"
+            )
 
-        for i in range(0, len(text), chunk_size):
-            chunk_text = text[i : i + chunk_size]
+            for i in range(0, len(text), chunk_size):
+                chunk_text = text[i : i + chunk_size]
 
-            delta = ChoiceDelta(
-                role="assistant",
-                content=chunk_text,
-            )
+                delta = ChoiceDelta(
+                    role="assistant",
+                    content=chunk_text,
+                )
 
-            chunk = ChatChunk(
-                id=str(uuid.uuid4()),
-                delta=delta,
-            )
+                chunk = ChatChunk(
+                    id=str(uuid.uuid4()),
+                    delta=delta,
+                )
 
-            logger.debug(
-                f"[N8N Stream] Sending chunk {i//chunk_size + 1}/{num_chunks}: {chunk_text[:20]}..."
-            )
-            self._event_ch.send_nowait(chunk)
-            await asyncio.sleep(0.02)  # Small delay for streaming effect
+                logger.debug(
+                    f"[N8N Stream] Sending chunk {i // chunk_size + 1}/{num_chunks}: {chunk_text[:20]}..."
+                )
+                self._event_ch.send_nowait(chunk)
+                await asyncio.sleep(0.02)  # Small delay for streaming effect
 
         # Signal completion
         logger.debug("[N8N Stream] All chunks sent, closing channel")
@@ -429,11 +581,12 @@ async def entrypoint(ctx: JobContext):
         metrics.log_metrics(ev.metrics)
         usage_collector.collect(ev.metrics)
 
-    async def log_usage():
+    async def on_shutdown():
         summary = usage_collector.get_summary()
         logger.info(f"Usage: {summary}")
+        await n8n_llm.aclose()
 
-    ctx.add_shutdown_callback(log_usage)
+    ctx.add_shutdown_callback(on_shutdown)
 
     # Start the session with a simple agent
     from livekit.agents import Agent
@@ -1,12 +1,47 @@
 """Shared fixtures and test configuration for n8n_agent tests"""
 import asyncio
+import sys
 import uuid
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, Mock
 
 import pytest
 from livekit.agents.llm import ChatContext, ChatMessage, ChoiceDelta
 
 
+@pytest.fixture(scope="session")
+def event_loop_policy():
+    """Run async tests on uvloop (lower per-await overhead) where it is available"""
+    if sys.platform == "win32":
+        # uvloop does not support Windows
+        return asyncio.DefaultEventLoopPolicy()
+    import uvloop
+
+    return uvloop.EventLoopPolicy()
+
+
+@pytest.fixture
+async def close_webhook_sessions(monkeypatch):
+    """Await aclose() on every N8nWebhookLLM that opened a pooled HTTP session
+
+    Opt in with pytest.mark.usefixtures in modules whose tests reach the
+    webhook, so other tests neither import n8n_agent nor patch it.
+    """
+    from n8n_agent import N8nWebhookLLM
+
+    opened = []
+    ensure_session = N8nWebhookLLM._ensure_session
+
+    async def tracking_ensure_session(self):
+        opened.append(self)
+        return await ensure_session(self)
+
+    monkeypatch.setattr(N8nWebhookLLM, "_ensure_session", tracking_ensure_session)
+    yield
+    for llm in opened:
+        await llm.aclose()
+
+
 @pytest.fixture
 def mock_chat_context():
     """Create a mock ChatContext with test messages"""
@@ -103,13 +138,12 @@ def mock_agent_session():
 def mock_job_context():
     """Mock JobContext for testing"""
     ctx = MagicMock()
-    ctx.room = MagicMock()
-    ctx.room.name = "test_room"
+    # Plain structural stubs: only MagicMock where call assertions are needed
+    ctx.room = SimpleNamespace(name="test_room")
     ctx.log_context_fields = {}
     ctx.add_shutdown_callback = MagicMock()
     ctx.connect = AsyncMock()
-    ctx.proc = MagicMock()
-    ctx.proc.userdata = {}
+    ctx.proc = SimpleNamespace(userdata={})
     ctx.inference_executor = MagicMock()  # Add inference_executor
     return ctx
 
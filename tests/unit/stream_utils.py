@@ -0,0 +1,13 @@
+"""Stream-consuming helpers shared by the n8n_agent unit tests"""
+
+import io
+
+
+async def drain_text(stream) -> str:
+    """Consume an LLM stream and return the concatenated delta text"""
+    # Single pass with a C-level write buffer; no chunk list is kept
+    buffer = io.StringIO()
+    async for chunk in stream:
+        if chunk.delta and chunk.delta.content:
+            buffer.write(chunk.delta.content)
+    return buffer.getvalue()
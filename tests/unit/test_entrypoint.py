@@ -1,9 +1,12 @@
 """Tests for entrypoint and helper functions"""
 import os
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
+pytestmark = pytest.mark.xdist_group(name="n8n_entrypoint")
+
 
 class TestEntrypoint:
     """Test the main entrypoint and helper functions"""
@@ -12,8 +15,7 @@ class TestEntrypoint:
         """Test that prewarm function loads VAD model"""
         from n8n_agent import prewarm
 
-        mock_proc = MagicMock()
-        mock_proc.userdata = {}
+        mock_proc = SimpleNamespace(userdata={})
 
         with patch('livekit.plugins.silero.VAD.load') as mock_vad_load:
             mock_vad = MagicMock()
@@ -24,7 +26,6 @@ class TestEntrypoint:
             mock_vad_load.assert_called_once()
             assert mock_proc.userdata["vad"] == mock_vad
 
-    @pytest.mark.asyncio
     async def test_entrypoint_requires_webhook_url(self, mock_job_context):
         """Test that entrypoint raises error without webhook URL"""
         from n8n_agent import entrypoint
@@ -37,7 +38,6 @@ class TestEntrypoint:
             with pytest.raises(ValueError, match="Missing n8n webhook URL"):
                 await entrypoint(mock_job_context)
 
-    @pytest.mark.asyncio
     async def test_entrypoint_with_webhook_url(self, mock_job_context):
         """Test entrypoint with valid webhook URL"""
         mock_job_context.proc.userdata = {"vad": MagicMock()}
@@ -89,7 +89,6 @@ class TestEntrypoint:
             finally:
                 _JobContextVar.reset(token)
 
-    @pytest.mark.asyncio
     async def test_entrypoint_without_token(self, mock_job_context):
         """Test entrypoint works without webhook token"""
         mock_job_context.proc.userdata = {"vad": MagicMock()}
@@ -130,7 +129,6 @@ class TestEntrypoint:
             finally:
                 _JobContextVar.reset(token)
 
-    @pytest.mark.asyncio
     async def test_entrypoint_registers_event_handlers(self, mock_job_context):
         """Test that entrypoint registers necessary event handlers"""
         mock_job_context.proc.userdata = {"vad": MagicMock()}
@@ -165,7 +163,6 @@ class TestEntrypoint:
             finally:
                 _JobContextVar.reset(token)
 
-    @pytest.mark.asyncio
     async def test_entrypoint_sets_log_context(self, mock_job_context):
         """Test that entrypoint sets up logging context"""
         mock_job_context.proc.userdata = {"vad": MagicMock()}
@@ -197,7 +194,6 @@ class TestEntrypoint:
             finally:
                 _JobContextVar.reset(token)
 
-    @pytest.mark.asyncio
     async def test_entrypoint_adds_shutdown_callback(self, mock_job_context):
         """Test that entrypoint adds usage logging shutdown callback"""
         mock_job_context.proc.userdata = {"vad": MagicMock()}
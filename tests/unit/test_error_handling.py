@@ -1,262 +1,261 @@
 """Tests for error handling and edge cases"""
 import asyncio
-from unittest.mock import AsyncMock, MagicMock, patch
+import json
 
-import aiohttp
 import pytest
-from aioresponses import aioresponses
+from aiohttp import web
+from aiohttp.test_utils import TestServer, unused_port
 from livekit.agents.llm import ChatContext, ChatMessage
+from stream_utils import drain_text
 
 from n8n_agent import N8nLLMStream, N8nWebhookLLM
 
+# Under --dist=loadgroup this keeps the module-scoped webhook server to one start
+pytestmark = [
+    pytest.mark.xdist_group(name="n8n_error_handling"),
+    pytest.mark.usefixtures("close_webhook_sessions"),
+]
+
+# ChatContext is read-only inside llm.chat(), so every test can share one
+_TEST_CTX = ChatContext(items=[ChatMessage(role="user", content=["Test"])])
+
+# Built once at import instead of on every run of test_very_long_response
+_LONG_TEXT = "A" * 10_000
+_LONG_PAYLOAD_JSON = json.dumps({"output": _LONG_TEXT}).encode()
+
+# Per-test description of what the webhook should answer
+RESPONSE_SPEC = web.AppKey("response_spec", dict)
+
+
+async def _webhook_handler(request: web.Request) -> web.StreamResponse:
+    """Answer according to the spec the current test installed"""
+    spec = request.app[RESPONSE_SPEC]
+    if spec.get("delay"):
+        await asyncio.sleep(spec["delay"])
+    if spec.get("fail_first"):
+        # Simulate a flaky gateway for the first N requests
+        spec["fail_first"] -= 1
+        return web.Response(status=503, text="Service Unavailable")
+    if spec.get("drop_connection"):
+        # Hang up on an accepted connection before any response bytes, which
+        # the client sees as ServerDisconnectedError (a ClientConnectionError)
+        request.transport.close()
+        return web.Response()
+    if "json" in spec:
+        return web.json_response(spec["json"], status=spec.get("status", 200))
+    if "body" in spec:
+        return web.Response(
+            status=spec.get("status", 200),
+            body=spec["body"],
+            content_type=spec.get("content_type", "application/json"),
+        )
+    return web.Response(
+        status=spec.get("status", 200),
+        text=spec.get("text", ""),
+        content_type=spec.get("content_type", "text/plain"),
+        headers=spec.get("headers"),
+    )
+
+
+@pytest.fixture(scope="module")
+async def webhook_server():
+    """In-process n8n webhook stand-in shared by every test in the module"""
+    app = web.Application()
+    app[RESPONSE_SPEC] = {}
+    app.router.add_post("/hook", _webhook_handler)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await server.close()
+
+
+@pytest.fixture
+def response_spec(webhook_server):
+    """Reset and expose the webhook response spec for one test"""
+    spec = webhook_server.app[RESPONSE_SPEC]
+    spec.clear()
+    return spec
+
+
+@pytest.fixture
+def mock_webhook_url(webhook_server):
+    """URL of the in-process webhook"""
+    return str(webhook_server.make_url("/hook"))
+
+
+@pytest.fixture
+def unreachable_webhook_url():
+    """URL on a local port nothing listens on"""
+    return f"http://127.0.0.1:{unused_port()}/hook"
+
 
 class TestErrorHandling:
     """Test error handling and edge cases"""
 
-    @pytest.mark.asyncio
-    async def test_timeout_handling(self, mock_webhook_url):
+    async def test_timeout_handling(self, mock_webhook_url, response_spec):
         """Test proper timeout handling"""
         llm = N8nWebhookLLM(mock_webhook_url, "", timeout=0.1)
 
-        with aioresponses() as m:
-            # Simulate timeout
-            m.post(mock_webhook_url, exception=aiohttp.ClientTimeout())
-
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
-
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+        # Simulate timeout
+        response_spec["delay"] = 1.0
+        response_spec["json"] = {"output": "Too late"}
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert "timeout" in result.lower() or "timed out" in result.lower()
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "timeout" in result.lower() or "timed out" in result.lower()
 
-    @pytest.mark.asyncio
-    async def test_network_error(self, mock_webhook_url):
+    async def test_network_error(self, unreachable_webhook_url):
         """Test handling of network errors"""
-        llm = N8nWebhookLLM(mock_webhook_url, "")
-
-        with aioresponses() as m:
-            m.post(mock_webhook_url, exception=aiohttp.ClientError("Connection failed"))
-
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        llm = N8nWebhookLLM(unreachable_webhook_url, "")
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "error" in result.lower()
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert "error" in result.lower()
-
-    @pytest.mark.asyncio
-    async def test_invalid_json_response(self, mock_webhook_url):
+    async def test_invalid_json_response(self, mock_webhook_url, response_spec):
         """Test handling of invalid JSON responses"""
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, body="Not valid JSON", content_type='text/plain')
-
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
-
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+        response_spec["text"] = "Not valid JSON"
 
-            # Should handle gracefully and return the plain text
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert len(result) > 0
+        # Should handle gracefully and return the plain text
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert len(result) > 0
 
-    @pytest.mark.asyncio
-    async def test_http_error_codes(self, mock_webhook_url):
+    @pytest.mark.parametrize("code", [400, 401, 403, 404, 500, 502, 503])
+    async def test_http_error_codes(self, mock_webhook_url, response_spec, code):
         """Test handling of various HTTP error codes"""
-        error_codes = [400, 401, 403, 404, 500, 502, 503]
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        for code in error_codes:
-            with aioresponses() as m:
-                m.post(mock_webhook_url, status=code, body=f"Error {code}")
-
-                ctx = ChatContext(items=[
-                    ChatMessage(role="user", content=["Test"])
-                ])
-
-                stream = llm.chat(ctx)
-                chunks = []
-                async for chunk in stream:
-                    chunks.append(chunk)
+        response_spec["status"] = code
+        response_spec["text"] = f"Error {code}"
 
-                result = "".join(c.delta.content for c in chunks if c.delta)
-                assert "trouble" in result.lower() or "error" in result.lower()
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "trouble" in result.lower() or "error" in result.lower()
 
-    @pytest.mark.asyncio
-    async def test_empty_response_body(self, mock_webhook_url):
-        """Test handling of empty response body"""
+    async def test_transient_gateway_error_is_retried(
+        self, mock_webhook_url, response_spec
+    ):
+        """Test that a 503 followed by success yields the real reply"""
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={})
+        response_spec["fail_first"] = 2
+        response_spec["json"] = {"output": "Recovered"}
 
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert result == "Recovered"
+        assert response_spec["fail_first"] == 0
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+    async def test_retries_share_one_turn_deadline(
+        self, mock_webhook_url, response_spec
+    ):
+        """Test that slow gateway errors cannot stretch a turn past its timeout"""
+        llm = N8nWebhookLLM(mock_webhook_url, "", timeout=0.5, max_attempts=5)
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert result == "I couldn't generate a response."
+        # Every attempt answers 503 after 0.2s; five of them plus backoff
+        # would take about 2.5s without a per-turn deadline
+        response_spec["delay"] = 0.2
+        response_spec["fail_first"] = 10
 
-    @pytest.mark.asyncio
-    async def test_null_values_in_response(self, mock_webhook_url):
-        """Test handling of null values in response"""
-        llm = N8nWebhookLLM(mock_webhook_url, "")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await drain_text(llm.chat(_TEST_CTX))
 
-        test_cases = [
-            {"output": None},
-            {"response": None, "text": None},
-            {"output": {"text": None}},
-        ]
+        assert loop.time() - started < 1.0
+        assert result
+        assert response_spec["fail_first"] >= 8
 
-        for response_data in test_cases:
-            with aioresponses() as m:
-                m.post(mock_webhook_url, payload=response_data)
-
-                ctx = ChatContext(items=[
-                    ChatMessage(role="user", content=["Test"])
-                ])
-
-                stream = llm.chat(ctx)
-                chunks = []
-                async for chunk in stream:
-                    chunks.append(chunk)
-
-                result = "".join(c.delta.content for c in chunks if c.delta)
-                assert result == "I couldn't generate a response."
-
-    @pytest.mark.asyncio
-    async def test_very_long_response(self, mock_webhook_url):
+    async def test_very_long_response(self, mock_webhook_url, response_spec):
         """Test handling of very long responses"""
-        # Create a very long text (10000 characters)
-        long_text = "A" * 10000
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={"output": long_text})
+        # Pre-serialized 10000-character reply
+        response_spec["body"] = _LONG_PAYLOAD_JSON
 
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        chunks = [chunk async for chunk in llm.chat(_TEST_CTX)]
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
-
-            # Verify chunking worked correctly
-            assert len(chunks) == 200  # 10000 / 50 (chunk size)
-
-            # Verify full text is preserved
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert result == long_text
-
-    @pytest.mark.asyncio
-    async def test_unicode_handling(self, mock_webhook_url):
-        """Test handling of unicode characters"""
-        unicode_text = "Hello 世界 🌍 Привет مرحبا"
+        # Without chunk_size the whole reply arrives as a single chunk
+        assert len(chunks) == 1
+        # Verify full text is preserved
+        assert chunks[0].delta.content == _LONG_TEXT
 
+    async def test_oversized_response_is_rejected(
+        self, mock_webhook_url, response_spec, monkeypatch
+    ):
+        """Test that replies past MAX_RESPONSE_BYTES become an error reply"""
+        monkeypatch.setattr("n8n_agent.MAX_RESPONSE_BYTES", 1024)
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={"output": unicode_text})
+        response_spec["body"] = _LONG_PAYLOAD_JSON
 
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "error" in result.lower()
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+    async def test_oversized_error_body_keeps_status_reply(
+        self, mock_webhook_url, response_spec, monkeypatch
+    ):
+        """Test that a large non-200 body is not buffered and still maps to its status"""
+        monkeypatch.setattr("n8n_agent.MAX_RESPONSE_BYTES", 1024)
+        llm = N8nWebhookLLM(mock_webhook_url, "")
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert result == unicode_text
+        response_spec["status"] = 500
+        response_spec["body"] = _LONG_PAYLOAD_JSON
 
-    @pytest.mark.asyncio
-    async def test_special_characters_in_response(self, mock_webhook_url):
-        """Test handling of special characters"""
-        special_text = 'Special chars: \n\t"quotes" \'single\' <tags> & symbols'
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "trouble" in result.lower()
 
+    async def test_connection_pool_error(self, mock_webhook_url, response_spec):
+        """Test handling of a pooled connection the server drops"""
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={"output": special_text})
-
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        response_spec["drop_connection"] = True
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "error" in result.lower()
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert result == special_text
+    async def test_redirect_handling(self, mock_webhook_url, response_spec):
+        """Test that redirects are not automatically followed (security)"""
+        redirect_url = "https://evil.com/webhook"
 
-    @pytest.mark.asyncio
-    async def test_connection_pool_error(self, mock_webhook_url):
-        """Test handling of connection pool errors"""
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with aioresponses() as m:
-            m.post(mock_webhook_url, exception=aiohttp.ClientConnectionError("Connection pool error"))
+        # Setup redirect
+        response_spec["status"] = 302
+        response_spec["headers"] = {"Location": redirect_url}
 
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        # Should treat redirect as error
+        result = await drain_text(llm.chat(_TEST_CTX))
+        assert "trouble" in result.lower() or "error" in result.lower()
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
 
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert "error" in result.lower()
+class TestResponseTextExtraction:
+    """Pure response-shape tests: no HTTP round-trip needed"""
 
-    @pytest.mark.asyncio
-    async def test_redirect_handling(self, mock_webhook_url):
-        """Test that redirects are not automatically followed (security)"""
-        redirect_url = "https://evil.com/webhook"
+    def test_empty_response_body(self):
+        """Test handling of empty response body"""
+        assert N8nLLMStream._extract_output_text({}) == "I couldn't generate a response."
 
-        llm = N8nWebhookLLM(mock_webhook_url, "")
+    @pytest.mark.parametrize(
+        "response_data",
+        [
+            {"output": None},
+            {"response": None, "text": None},
+            {"output": {"text": None}},
+        ],
+    )
+    def test_null_values_in_response(self, response_data):
+        """Test handling of null values in response"""
+        result = N8nLLMStream._extract_output_text(response_data)
+        assert result == "I couldn't generate a response."
 
-        with aioresponses() as m:
-            # Setup redirect
-            m.post(mock_webhook_url, status=302, headers={"Location": redirect_url})
-            m.post(redirect_url, payload={"output": "Should not reach here"})
+    def test_unicode_handling(self):
+        """Test handling of unicode characters"""
+        unicode_text = "Hello 世界 🌍 Привет مرحبا"
 
-            ctx = ChatContext(items=[
-                ChatMessage(role="user", content=["Test"])
-            ])
+        result = N8nLLMStream._extract_output_text({"output": unicode_text})
+        assert result == unicode_text
 
-            stream = llm.chat(ctx)
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+    def test_special_characters_in_response(self):
+        """Test handling of special characters"""
+        special_text = 'Special chars: \n\t"quotes" \'single\' <tags> & symbols'
 
-            # Should treat redirect as error
-            result = "".join(c.delta.content for c in chunks if c.delta)
-            assert "trouble" in result.lower() or "error" in result.lower()
\ No newline at end of file
+        result = N8nLLMStream._extract_output_text({"output": special_text})
+        assert result == special_text
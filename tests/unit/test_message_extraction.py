@@ -1,105 +1,120 @@
 """Tests for message extraction from ChatContext"""
+from unittest.mock import MagicMock
+
 import pytest
 from livekit.agents.llm import ChatContext, ChatMessage
-from unittest.mock import MagicMock, patch
 
+from message_extraction import extract_latest_user_text
 from n8n_agent import N8nWebhookLLM
 
+pytestmark = pytest.mark.xdist_group(name="n8n_message_extraction")
+
+# Messages and contexts are read-only inside llm.chat(), so they are built once
+# at import instead of in every test
+_MSG_HELLO = ChatMessage(role="user", content=["Hello, how are you?"])
+_MSG_TEST = ChatMessage(role="user", content=["Test"])
+_MSG_SYS = ChatMessage(role="system", content=["You are a helpful assistant"])
+_MSG_ASSISTANT = ChatMessage(role="assistant", content=["Response"])
+
+_TEST_CTX = ChatContext(items=[_MSG_TEST])
+_HELLO_CTX = ChatContext(items=[_MSG_HELLO])
+_EMPTY_CTX = ChatContext(items=[])
+_CONVERSATION_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=["First message"]),
+    _MSG_ASSISTANT,
+    ChatMessage(role="user", content=["Second message"]),
+    ChatMessage(role="assistant", content=["Another response"]),
+    ChatMessage(role="user", content=["Latest message"]),
+])
+_SYSTEM_MESSAGES_CTX = ChatContext(items=[
+    _MSG_SYS,
+    ChatMessage(role="user", content=["What is Python?"]),
+    ChatMessage(role="system", content=["Be concise"]),
+])
+_MULTIPART_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=["Part 1", "Part 2", "Part 3"]),
+])
+_MIXED_CONTENT_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=["String content", "Another string"]),
+])
+_NO_USER_CTX = ChatContext(items=[
+    ChatMessage(role="system", content=["System prompt"]),
+    ChatMessage(role="assistant", content=["Assistant message"]),
+])
+_TEST_MESSAGE_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=["Test message"]),
+])
+_UNICODE_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=["Hello 世界 🌍"]),
+])
+_EMPTY_CONTENT_CTX = ChatContext(items=[
+    ChatMessage(role="user", content=[""]),
+    ChatMessage(role="user", content=["Non-empty"]),
+])
+
+
+@pytest.fixture(autouse=True)
+def patch_stream(monkeypatch):
+    """Swap N8nLLMStream for a mock so chat() only builds the payload"""
+    # monkeypatch.setattr is a plain setattr; patch() as a context manager
+    # costs a lookup and descriptor juggling on every test
+    mock = MagicMock()
+    monkeypatch.setattr("n8n_agent.N8nLLMStream", mock)
+    return mock
+
 
 class TestMessageExtraction:
     """Test message extraction logic from ChatContext"""
 
-    def test_extract_simple_user_message(self, mock_webhook_url):
+    def test_extract_simple_user_message(self, mock_webhook_url, patch_stream):
         """Test extraction of simple user message"""
-        messages = [
-            ChatMessage(role="user", content=["Hello, how are you?"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
+        llm.chat(_HELLO_CTX)
 
-            # Get the payload passed to stream
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        # Get the payload passed to stream
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == "Hello, how are you?"
+        assert payload["input"]["text"] == "Hello, how are you?"
 
-    def test_extract_latest_user_message(self, mock_webhook_url):
+    def test_extract_latest_user_message(self, mock_webhook_url, patch_stream):
         """Test extraction of latest user message from conversation"""
-        messages = [
-            ChatMessage(role="user", content=["First message"]),
-            ChatMessage(role="assistant", content=["Response"]),
-            ChatMessage(role="user", content=["Second message"]),
-            ChatMessage(role="assistant", content=["Another response"]),
-            ChatMessage(role="user", content=["Latest message"]),
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
+        llm.chat(_CONVERSATION_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        assert payload["input"]["text"] == "Latest message"
 
-            assert payload["input"]["text"] == "Latest message"
-
-    def test_extract_from_empty_context(self, mock_webhook_url):
+    def test_extract_from_empty_context(self, mock_webhook_url, patch_stream):
         """Test extraction from empty ChatContext"""
-        ctx = ChatContext(items=[])
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(_EMPTY_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == ""
+        assert payload["input"]["text"] == ""
 
-    def test_extract_with_system_messages(self, mock_webhook_url):
+    def test_extract_with_system_messages(self, mock_webhook_url, patch_stream):
         """Test extraction ignores system messages"""
-        messages = [
-            ChatMessage(role="system", content=["You are a helpful assistant"]),
-            ChatMessage(role="user", content=["What is Python?"]),
-            ChatMessage(role="system", content=["Be concise"]),
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(_SYSTEM_MESSAGES_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == "What is Python?"
+        assert payload["input"]["text"] == "What is Python?"
 
-    def test_extract_multipart_content(self, mock_webhook_url):
+    def test_extract_multipart_content(self, mock_webhook_url, patch_stream):
         """Test extraction from messages with multiple content parts"""
-        messages = [
-            ChatMessage(role="user", content=["Part 1", "Part 2", "Part 3"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
+        llm.chat(_MULTIPART_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        # Should get the first part
+        assert payload["input"]["text"] == "Part 1"
 
-            # Should get the first part
-            assert payload["input"]["text"] == "Part 1"
-
-    def test_extract_with_content_objects(self, mock_webhook_url):
+    def test_extract_with_content_objects(self, mock_webhook_url, patch_stream):
         """Test extraction when content has object structure"""
         # For this test, we'll directly test the extraction logic
         # by mocking the ChatContext to return objects with text attributes
@@ -123,53 +138,33 @@ class TestMessageExtraction:
 
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(ctx)
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == "Content from object"
+        assert payload["input"]["text"] == "Content from object"
 
-    def test_extract_mixed_content_types(self, mock_webhook_url):
+    def test_extract_mixed_content_types(self, mock_webhook_url, patch_stream):
         """Test extraction with mixed content types"""
         # Test with valid ChatMessage containing only strings
         # (since ChatMessage validates content types)
-        messages = [
-            ChatMessage(role="user", content=["String content", "Another string"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
+        llm.chat(_MIXED_CONTENT_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        # Should get the first string content
+        assert payload["input"]["text"] == "String content"
 
-            # Should get the first string content
-            assert payload["input"]["text"] == "String content"
-
-    def test_extract_no_user_messages(self, mock_webhook_url):
+    def test_extract_no_user_messages(self, mock_webhook_url, patch_stream):
         """Test extraction when there are no user messages"""
-        messages = [
-            ChatMessage(role="system", content=["System prompt"]),
-            ChatMessage(role="assistant", content=["Assistant message"]),
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(_NO_USER_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == ""
+        assert payload["input"]["text"] == ""
 
-    def test_extract_with_exception_handling(self, mock_webhook_url):
+    def test_extract_with_exception_handling(self, mock_webhook_url, patch_stream):
         """Test that extraction handles exceptions gracefully"""
         # Test that even with a completely broken context,
         # the code handles it gracefully and creates a stream with empty text
@@ -177,89 +172,77 @@ class TestMessageExtraction:
 
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
+        llm.chat(ctx)
 
-            # Should still create stream with empty text
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
-            assert payload["input"]["text"] == ""
+        # Should still create stream with empty text
+        payload = patch_stream.call_args[0][5]
+        assert payload["input"]["text"] == ""
 
-    def test_context_iteration_methods(self, mock_webhook_url):
+    def test_context_iteration_methods(self, mock_webhook_url, patch_stream):
         """Test different methods of accessing messages in ChatContext"""
-        messages = [
-            ChatMessage(role="user", content=["Test message"])
-        ]
-
-        # Test with messages property
-        ctx = ChatContext(items=messages)
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
-            assert payload["input"]["text"] == "Test message"
+        llm.chat(_TEST_MESSAGE_CTX)
+        payload = patch_stream.call_args[0][5]
+        assert payload["input"]["text"] == "Test message"
 
-    def test_unicode_in_messages(self, mock_webhook_url):
+    def test_unicode_in_messages(self, mock_webhook_url, patch_stream):
         """Test extraction of unicode content"""
-        messages = [
-            ChatMessage(role="user", content=["Hello 世界 🌍"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(_UNICODE_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            assert payload["input"]["text"] == "Hello 世界 🌍"
+        assert payload["input"]["text"] == "Hello 世界 🌍"
 
-    def test_empty_content_in_message(self, mock_webhook_url):
+    def test_empty_content_in_message(self, mock_webhook_url, patch_stream):
         """Test handling of empty content in messages"""
-        messages = [
-            ChatMessage(role="user", content=[""]),
-            ChatMessage(role="user", content=["Non-empty"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
+        llm.chat(_EMPTY_CONTENT_CTX)
+        payload = patch_stream.call_args[0][5]
 
-            # Should skip empty and get the non-empty message
-            assert payload["input"]["text"] == "Non-empty"
+        # Should skip empty and get the non-empty message
+        assert payload["input"]["text"] == "Non-empty"
 
-    def test_payload_structure_completeness(self, mock_webhook_url):
+    def test_payload_structure_completeness(self, mock_webhook_url, patch_stream):
         """Test that the complete payload structure is correct"""
-        messages = [
-            ChatMessage(role="user", content=["Test"])
-        ]
-        ctx = ChatContext(items=messages)
-
         llm = N8nWebhookLLM(mock_webhook_url, "token")
 
-        with patch('n8n_agent.N8nLLMStream') as mock_stream:
-            llm.chat(ctx)
-
-            call_args = mock_stream.call_args[0]
-            payload = call_args[5]
-
-            # Check complete payload structure
-            assert "session_id" in payload
-            assert "turn_id" in payload
-            assert "input" in payload
-            assert "context" in payload
-            assert "idempotency_key" in payload
-
-            assert payload["input"]["type"] == "text"
-            assert payload["input"]["text"] == "Test"
-            assert payload["turn_id"] == "t_1"
-            assert isinstance(payload["context"], dict)
\ No newline at end of file
+        llm.chat(_TEST_CTX)
+        payload = patch_stream.call_args[0][5]
+
+        # Check complete payload structure
+        assert "session_id" in payload
+        assert "turn_id" in payload
+        assert "input" in payload
+        assert "context" in payload
+        assert "idempotency_key" in payload
+
+        assert payload["input"]["type"] == "text"
+        assert payload["input"]["text"] == "Test"
+        assert payload["turn_id"] == "t_1"
+        assert isinstance(payload["context"], dict)
+
+
+class TestExtractLatestUserText:
+    """Direct tests for the extraction helper, no LLM involved"""
+
+    def test_returns_latest_user_text(self):
+        """Test that the most recent user turn wins"""
+        ctx = ChatContext(items=[
+            ChatMessage(role="user", content=["First"]),
+            ChatMessage(role="assistant", content=["Reply"]),
+            ChatMessage(role="user", content=["Second"]),
+        ])
+        assert extract_latest_user_text(ctx) == "Second"
+
+    def test_no_user_message_returns_empty(self):
+        """Test that a context without user turns yields an empty string"""
+        ctx = ChatContext(items=[ChatMessage(role="system", content=["System"])])
+        assert extract_latest_user_text(ctx) == ""
+
+    def test_plain_list_of_messages(self):
+        """Test that any iterable of messages is accepted"""
+        messages = [ChatMessage(role="user", content=["Hi"])]
+        assert extract_latest_user_text(messages) == "Hi"
@@ -1,15 +1,112 @@
 """Unit tests for N8nLLMStream class"""
 import asyncio
-import uuid
-from unittest.mock import AsyncMock, MagicMock, patch
+import itertools
 
 import aiohttp
 import pytest
-from aioresponses import aioresponses
-from livekit.agents.llm import ChatChunk, ChatMessage, ChoiceDelta, LLMStream
+from aioresponses import CallbackResult, aioresponses
+from livekit.agents.llm import ChatChunk, ChatMessage, ChoiceDelta
+from livekit.agents.utils.aio import Chan
 
 from n8n_agent import N8nLLMStream, N8nWebhookLLM
 
+# Tests only need distinct keys, not uuid4's os.urandom() read per test
+_idempotency_keys = itertools.count()
+
+
+def _next_idempotency_key():
+    return f"idem-{next(_idempotency_keys)}"
+
+
+# Reply for test_chunking_mechanism: longer than its chunk size (50)
+_LONG_TEXT = "A" * 150
+_EXPECTED_CHUNKS = [_LONG_TEXT[i : i + 50] for i in range(0, 150, 50)]
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+class _CallCounter:
+    """Awaitable stub that counts calls; far cheaper to build than AsyncMock"""
+
+    def __init__(self, result=None):
+        self.calls = 0
+        self.result = result
+
+    async def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.result
+
+
+# Under --dist=loadgroup this keeps mocked_http to one patch for the class
+pytestmark = [
+    pytest.mark.xdist_group(name="n8n_llm_stream"),
+    pytest.mark.usefixtures("close_webhook_sessions"),
+]
+
+
+@pytest.fixture(scope="class")
+def mocked_http():
+    """One aioresponses patch for the whole class instead of one per test"""
+    with aioresponses() as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def reset_mocked_http(request):
+    """Drop registrations and recorded calls left by the previous test"""
+    if "mocked_http" in request.fixturenames:
+        m = request.getfixturevalue("mocked_http")
+        # clear() only drops registered matches; recorded calls live in
+        # m.requests and would otherwise accumulate across the class
+        m.clear()
+        m.requests.clear()
+
+
+def _reply_if_authorized(url, **kwargs):
+    """Answer "Authorized" only when the expected bearer token was sent"""
+    authorized = kwargs.get("headers", {}).get("Authorization") == "Bearer test_token"
+    return CallbackResult(payload={"output": "Authorized" if authorized else "Denied"})
+
+
+# (webhook token, aioresponses reply kwargs, check on the cursor text)
+FETCH_RESPONSE_CASES = [
+    pytest.param(
+        "", {"payload": {"output": "Test response from n8n"}},
+        lambda text: text == "Test response from n8n", id="success",
+    ),
+    pytest.param(
+        "", {"payload": {"output": {"text": "Nested response"}}},
+        lambda text: text == "Nested response", id="complex_output",
+    ),
+    pytest.param(
+        "", {"payload": {"response": "Using response key"}},
+        lambda text: text == "Using response key", id="alternative_keys",
+    ),
+    pytest.param(
+        "test_token", {"callback": _reply_if_authorized},
+        lambda text: text == "Authorized", id="with_auth_token",
+    ),
+    pytest.param(
+        "", {"exception": asyncio.TimeoutError()},
+        lambda text: "timeout" in text.lower() or "timed out" in text.lower(),
+        id="timeout",
+    ),
+    pytest.param(
+        "", {"payload": {"error": "Internal server error"}, "status": 500},
+        lambda text: "trouble" in text.lower(), id="error_status",
+    ),
+    pytest.param(
+        "", {"exception": aiohttp.ClientError("Network error")},
+        lambda text: "error" in text.lower(), id="network_error",
+    ),
+    pytest.param(
+        "", {"payload": {}},
+        lambda text: text == "I couldn't generate a response.", id="empty_response",
+    ),
+]
+
 
 class TestN8nLLMStream:
     """Test suite for N8nLLMStream class"""
@@ -32,10 +129,27 @@ class TestN8nLLMStream:
                 "text": "Test message"
             },
             "context": {},
-            "idempotency_key": str(uuid.uuid4())
+            "idempotency_key": _next_idempotency_key()
         }
 
-    @pytest.mark.asyncio
+    @pytest.fixture
+    def make_stream(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
+        """Build an N8nLLMStream without LLMStream.__init__ or its background task"""
+        # Tests that drive _fetch_response directly only need these attributes;
+        # the real constructor would also start a _run task hitting the webhook
+        def _make(token="", timeout=5.0):
+            stream = N8nLLMStream.__new__(N8nLLMStream)
+            stream._llm = mock_llm
+            stream._chat_ctx = mock_chat_context
+            stream.webhook_url = mock_webhook_url
+            stream.webhook_token = token
+            stream.payload = sample_payload
+            stream.timeout = timeout
+            stream._event_ch = Chan[ChatChunk](128)
+            return stream
+
+        return _make
+
     async def test_stream_init(self, mock_llm, mock_chat_context, mock_webhook_url, mock_webhook_token, sample_payload):
         """Test N8nLLMStream initialization"""
         stream = N8nLLMStream(
@@ -53,7 +167,6 @@ class TestN8nLLMStream:
         assert stream.payload == sample_payload
         assert stream.timeout == 10.0
 
-    @pytest.mark.asyncio
     async def test_stream_context_manager(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
         """Test stream works as async context manager"""
         stream = N8nLLMStream(
@@ -61,8 +174,8 @@ class TestN8nLLMStream:
             mock_webhook_url, "token", sample_payload, 5.0
         )
 
-        # Mock the _run method to avoid actual webhook calls
-        stream._run = AsyncMock()
+        # Stub the _run method to avoid actual webhook calls
+        stream._run = _noop
 
         async with stream as s:
             assert s == stream
@@ -70,268 +183,111 @@ class TestN8nLLMStream:
         # Verify cleanup happens
         assert stream._task is not None
 
-    @pytest.mark.asyncio
-    async def test_fetch_response_success(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test successful webhook response handling"""
-        with aioresponses() as m:
-            # Allow repeated calls to the same URL
-            m.post(
-                mock_webhook_url,
-                payload={"output": "Test response from n8n"},
-                status=200,
-                repeat=True  # Allow multiple calls
-            )
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-            # Check that cursor was set
-            assert mock_chat_context in mock_llm._cursors
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert isinstance(cursor_msg, ChatMessage)
-            assert cursor_msg.role == "assistant"
-            assert cursor_msg.content == ["Test response from n8n"]
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_complex_output(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test handling complex nested response structures"""
-        with aioresponses() as m:
-            m.post(
-                mock_webhook_url,
-                payload={"output": {"text": "Nested response"}},
-                status=200,
-                repeat=True
-            )
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert cursor_msg.content == ["Nested response"]
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_alternative_keys(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test response extraction with alternative key names"""
-        with aioresponses() as m:
-            # Test 'response' key
-            m.post(
-                mock_webhook_url,
-                payload={"response": "Using response key"},
-                status=200,
-                repeat=True
-            )
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert cursor_msg.content == ["Using response key"]
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_with_auth_token(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test that auth token is included in headers"""
-        with aioresponses() as m:
-            def check_headers(url, **kwargs):
-                headers = kwargs.get('headers', {})
-                assert headers.get('Authorization') == 'Bearer test_token'
-                return aiohttp.web.json_response({"output": "Authorized"})
-
-            m.post(mock_webhook_url, callback=check_headers, repeat=True)
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "test_token", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_timeout(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test timeout handling"""
-        with aioresponses() as m:
-            # Simulate timeout by raising TimeoutError
-            m.post(mock_webhook_url, exception=asyncio.TimeoutError(), repeat=True)
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 1.0
-            )
-
-            await stream._fetch_response()
-
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert "timeout" in cursor_msg.content[0].lower() or "timed out" in cursor_msg.content[0].lower()
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_error_status(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test handling of error HTTP status codes"""
-        with aioresponses() as m:
-            m.post(
-                mock_webhook_url,
-                payload={"error": "Internal server error"},
-                status=500,
-                repeat=True
-            )
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert "trouble" in cursor_msg.content[0].lower()
-
-    @pytest.mark.asyncio
-    async def test_fetch_response_network_error(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test handling of network errors"""
-        with aioresponses() as m:
-            m.post(mock_webhook_url, exception=aiohttp.ClientError("Network error"), repeat=True)
-
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
-
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert "error" in cursor_msg.content[0].lower()
-
-    @pytest.mark.asyncio
-    async def test_chunking_mechanism(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test that response is properly chunked"""
-        long_text = "A" * 150  # Create text longer than chunk size (50)
-
-        with aioresponses() as m:
-            # Only allow one call to avoid duplicates
-            m.post(mock_webhook_url, payload={"output": long_text})
+    @pytest.mark.parametrize("token,reply,check", FETCH_RESPONSE_CASES)
+    async def test_fetch_response(self, mocked_http, make_stream, mock_llm, mock_chat_context, mock_webhook_url, token, reply, check):
+        """Test webhook reply handling across payload shapes and failures"""
+        mocked_http.post(mock_webhook_url, repeat=True, **reply)
 
-            # Track chunks sent to event channel
-            chunks_sent = []
+        stream = make_stream(token=token)
 
-            # Create stream but DON'T let background task run
-            with patch.object(LLMStream, '__init__', lambda self, *args, **kwargs: None):
-                stream = N8nLLMStream.__new__(N8nLLMStream)
-                stream._llm = mock_llm
-                stream._chat_ctx = mock_chat_context
-                stream.webhook_url = mock_webhook_url
-                stream.webhook_token = ""
-                stream.payload = sample_payload
-                stream.timeout = 5.0
+        await stream._fetch_response()
 
-                # Create a mock event channel
-                from livekit.agents.utils.aio import Chan
-                stream._event_ch = Chan[ChatChunk](128)
+        # Check that cursor was set
+        cursor_msg = mock_llm._cursors[mock_chat_context]
+        assert isinstance(cursor_msg, ChatMessage)
+        assert cursor_msg.role == "assistant"
+        assert check(cursor_msg.content[0])
 
-                # Track chunks
-                original_send = stream._event_ch.send_nowait
-
-                def track_chunk(chunk):
-                    chunks_sent.append(chunk)
-                    original_send(chunk)
-
-                stream._event_ch.send_nowait = track_chunk
+    async def test_chunking_mechanism(self, mocked_http, make_stream, mock_llm, mock_webhook_url):
+        """Test that response is properly chunked"""
+        mock_llm.chunk_size = 50
 
-                # Now call fetch_response directly
-                await stream._fetch_response()
+        # Only allow one call to avoid duplicates
+        mocked_http.post(mock_webhook_url, payload={"output": _LONG_TEXT}, repeat=False)
 
-            # Should create 3 chunks (150 / 50)
-            assert len(chunks_sent) == 3
+        # Track chunks sent to event channel
+        chunks_sent = []
 
-            # Verify chunk structure
-            for chunk in chunks_sent:
-                assert isinstance(chunk, ChatChunk)
-                assert chunk.delta is not None
-                assert isinstance(chunk.delta, ChoiceDelta)
+        # Create stream but DON'T let background task run
+        stream = make_stream()
 
-            # Reconstruct text from chunks
-            reconstructed = "".join(c.delta.content for c in chunks_sent)
-            assert reconstructed == long_text
+        # Track chunks
+        original_send = stream._event_ch.send_nowait
 
-    @pytest.mark.asyncio
-    async def test_stream_iteration(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test async iteration over stream"""
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={"output": "Short text"}, repeat=True)
+        def track_chunk(chunk):
+            chunks_sent.append(chunk)
+            original_send(chunk)
 
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
+        stream._event_ch.send_nowait = track_chunk
 
-            chunks = []
-            async for chunk in stream:
-                chunks.append(chunk)
+        # Now call fetch_response directly
+        await stream._fetch_response()
 
-            assert len(chunks) == 1
-            assert chunks[0].delta.content == "Short text"
+        # Should create 3 chunks (150 / 50)
+        assert len(chunks_sent) == 3
 
-    @pytest.mark.asyncio
-    async def test_empty_response_handling(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test handling of empty responses"""
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={}, repeat=True)
+        # Verify chunk structure
+        for chunk, expected in zip(chunks_sent, _EXPECTED_CHUNKS):
+            assert isinstance(chunk, ChatChunk)
+            assert chunk.delta is not None
+            assert isinstance(chunk.delta, ChoiceDelta)
+            assert chunk.delta.content == expected
 
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
-
-            await stream._fetch_response()
+        # Reconstruct text from chunks
+        reconstructed = (
+            chunks_sent[0].delta.content
+            + chunks_sent[1].delta.content
+            + chunks_sent[2].delta.content
+        )
+        assert reconstructed == _LONG_TEXT
+        mocked_http.assert_called_once()
 
-            cursor_msg = mock_llm._cursors[mock_chat_context]
-            assert cursor_msg.content == ["I couldn't generate a response."]
+    async def test_stream_iteration(self, mocked_http, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
+        """Test async iteration over stream"""
+        mocked_http.post(mock_webhook_url, payload={"output": "Short text"})
 
-    @pytest.mark.asyncio
-    async def test_run_method(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
-        """Test the _run method delegates to _fetch_response"""
         stream = N8nLLMStream(
             mock_llm, mock_chat_context, None,
             mock_webhook_url, "", sample_payload, 5.0
         )
 
-        stream._fetch_response = AsyncMock()
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+
+        assert len(chunks) == 1
+        assert chunks[0].delta.content == "Short text"
+        # Only the constructor's background _run task reaches the webhook
+        mocked_http.assert_called_once()
+
+    async def test_run_method(self, make_stream):
+        """Test the _run method delegates to _fetch_response"""
+        stream = make_stream()
+
+        stream._fetch_response = fetch = _CallCounter()
 
         await stream._run()
 
-        stream._fetch_response.assert_called_once()
+        assert fetch.calls == 1
 
-    @pytest.mark.asyncio
-    async def test_event_channel_close(self, mock_llm, mock_chat_context, mock_webhook_url, sample_payload):
+    async def test_event_channel_close(self, mocked_http, make_stream, mock_webhook_url):
         """Test that event channel is properly closed"""
-        with aioresponses() as m:
-            m.post(mock_webhook_url, payload={"output": "Test"}, repeat=True)
+        mocked_http.post(mock_webhook_url, payload={"output": "Test"})
 
-            stream = N8nLLMStream(
-                mock_llm, mock_chat_context, None,
-                mock_webhook_url, "", sample_payload, 5.0
-            )
+        stream = make_stream()
 
-            # Mock the close method to track if it's called
-            close_called = False
-            original_close = stream._event_ch.close
+        # Mock the close method to track if it's called
+        close_called = False
+        original_close = stream._event_ch.close
 
-            def track_close():
-                nonlocal close_called
-                close_called = True
-                return original_close()
+        def track_close():
+            nonlocal close_called
+            close_called = True
+            return original_close()
 
-            stream._event_ch.close = track_close
+        stream._event_ch.close = track_close
 
-            await stream._fetch_response()
+        await stream._fetch_response()
 
-            assert close_called
\ No newline at end of file
+        assert close_called
+        mocked_http.assert_called_once()
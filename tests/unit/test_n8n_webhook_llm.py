@@ -3,8 +3,18 @@ import uuid
 from unittest.mock import MagicMock, patch
 
 import pytest
+from aioresponses import aioresponses
+from livekit.agents.llm import ChatContext, ChatMessage
+from stream_utils import drain_text
 
-from n8n_agent import N8nWebhookLLM
+from n8n_agent import EMPTY_REPLY_TEXT, N8nWebhookLLM
+
+pytestmark = [
+    pytest.mark.xdist_group(name="n8n_webhook_llm"),
+    pytest.mark.usefixtures("close_webhook_sessions"),
+]
+
+_HI_CTX = ChatContext(items=[ChatMessage(role="user", content=["Hi"])])
 
 
 class TestN8nWebhookLLM:
@@ -34,6 +44,18 @@ class TestN8nWebhookLLM:
 
         assert llm.timeout == 8.0
         assert llm.webhook_token == ""
+        assert llm.chunk_size is None
+
+    @pytest.mark.parametrize("chunk_size", [0, -1])
+    def test_init_rejects_non_positive_chunk_size(self, mock_webhook_url, chunk_size):
+        """Test that a chunk_size below 1 is refused up front"""
+        with pytest.raises(ValueError, match="chunk_size"):
+            N8nWebhookLLM(mock_webhook_url, "", chunk_size=chunk_size)
+
+    def test_init_rejects_zero_max_attempts(self, mock_webhook_url):
+        """Test that max_attempts below 1 is refused up front"""
+        with pytest.raises(ValueError, match="max_attempts"):
+            N8nWebhookLLM(mock_webhook_url, "", max_attempts=0)
 
     def test_session_id_generation(self, mock_webhook_url):
         """Test that each instance gets a unique session ID"""
@@ -46,77 +68,41 @@ class TestN8nWebhookLLM:
         uuid.UUID(llm2.session_id)
 
     @patch('n8n_agent.N8nLLMStream')
-    def test_chat_creates_stream(self, mock_stream_class, mock_webhook_url, mock_chat_context):
-        """Test that chat() creates and returns an N8nLLMStream"""
+    def test_chat_batched(self, mock_stream_class, mock_webhook_url, mock_chat_context,
+                          mock_chat_context_complex, mock_chat_context_empty):
+        """Test chat() stream creation, turn counting and message extraction over several turns"""
+        # One patch and one LLM serve every turn instead of a fresh setup per case
         llm = N8nWebhookLLM(mock_webhook_url, "token")
         mock_stream = MagicMock()
         mock_stream_class.return_value = mock_stream
 
-        result = llm.chat(mock_chat_context)
-
-        assert result == mock_stream
-        mock_stream_class.assert_called_once()
-
-        # Verify the stream was created with correct parameters
-        call_args = mock_stream_class.call_args
-        assert call_args[0][0] == llm  # First arg is the LLM instance
-        assert call_args[0][1] == mock_chat_context  # Second is chat context
-
-    @patch('n8n_agent.N8nLLMStream')
-    def test_chat_increments_turn_counter(self, mock_stream_class, mock_webhook_url, mock_chat_context):
-        """Test that each chat() call increments the turn counter"""
-        llm = N8nWebhookLLM(mock_webhook_url, "token")
-        mock_stream_class.return_value = MagicMock()
-
         assert llm.turn_counter == 0
 
-        llm.chat(mock_chat_context)
-        assert llm.turn_counter == 1
+        turns = [
+            (1, mock_chat_context, "Hello, how are you?"),
+            # Should extract the most recent user message
+            (2, mock_chat_context_complex, "Tell me about AI"),
+            # Should have empty text when no messages
+            (3, mock_chat_context_empty, ""),
+        ]
+        for turn, ctx, expected_text in turns:
+            result = llm.chat(ctx)
 
-        llm.chat(mock_chat_context)
-        assert llm.turn_counter == 2
+            assert result == mock_stream
+            assert llm.turn_counter == turn
 
-    @patch('n8n_agent.N8nLLMStream')
-    def test_chat_extracts_user_message(self, mock_stream_class, mock_webhook_url, mock_chat_context):
-        """Test that chat() correctly extracts user messages"""
-        llm = N8nWebhookLLM(mock_webhook_url, "token")
-
-        llm.chat(mock_chat_context)
+            # Verify the stream was created with correct parameters
+            call_args = mock_stream_class.call_args[0]
+            assert call_args[0] == llm  # First arg is the LLM instance
+            assert call_args[1] == ctx  # Second is chat context
 
-        # Get the payload that was passed to the stream
-        call_args = mock_stream_class.call_args[0]
-        payload = call_args[5]  # 6th argument is payload
+            payload = call_args[5]  # 6th argument is payload
+            assert payload["input"]["text"] == expected_text
+            assert payload["input"]["type"] == "text"
+            assert payload["session_id"] == llm.session_id
+            assert payload["turn_id"] == f"t_{turn}"
 
-        assert payload["input"]["text"] == "Hello, how are you?"
-        assert payload["input"]["type"] == "text"
-        assert payload["session_id"] == llm.session_id
-        assert payload["turn_id"] == "t_1"
-
-    @patch('n8n_agent.N8nLLMStream')
-    def test_chat_handles_empty_context(self, mock_stream_class, mock_webhook_url, mock_chat_context_empty):
-        """Test chat() handles empty chat context gracefully"""
-        llm = N8nWebhookLLM(mock_webhook_url, "token")
-
-        llm.chat(mock_chat_context_empty)
-
-        call_args = mock_stream_class.call_args[0]
-        payload = call_args[5]
-
-        # Should have empty text when no messages
-        assert payload["input"]["text"] == ""
-
-    @patch('n8n_agent.N8nLLMStream')
-    def test_chat_with_complex_context(self, mock_stream_class, mock_webhook_url, mock_chat_context_complex):
-        """Test chat() extracts the latest user message from complex context"""
-        llm = N8nWebhookLLM(mock_webhook_url, "token")
-
-        llm.chat(mock_chat_context_complex)
-
-        call_args = mock_stream_class.call_args[0]
-        payload = call_args[5]
-
-        # Should extract the most recent user message
-        assert payload["input"]["text"] == "Tell me about AI"
+        assert mock_stream_class.call_count == len(turns)
 
     @patch('n8n_agent.N8nLLMStream')
     def test_chat_with_optional_parameters(self, mock_stream_class, mock_webhook_url, mock_chat_context):
@@ -162,4 +148,77 @@ class TestN8nWebhookLLM:
         llm._cursors[mock_ctx] = mock_message
 
         assert mock_ctx in llm._cursors
-        assert llm._cursors[mock_ctx] == mock_message
\ No newline at end of file
+        assert llm._cursors[mock_ctx] == mock_message
+
+    async def test_http_session_is_reused_and_closed(self, mock_webhook_url):
+        """Test that one pooled HTTP session serves every turn until aclose()"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token")
+
+        session = await llm._ensure_session()
+        assert await llm._ensure_session() is session
+
+        await llm.aclose()
+        assert session.closed
+
+    def test_response_cache_disabled_by_default(self, mock_webhook_url):
+        """Test that replies are never cached unless cache_ttl is set"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token")
+
+        llm._store_reply(_HI_CTX, "Hello")
+
+        assert llm._cached_reply(_HI_CTX) is None
+
+    def test_response_cache_hits_identical_history(self, mock_webhook_url):
+        """Test that a regenerated reply for the same history is served from cache"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token", cache_ttl=60.0)
+
+        llm._store_reply(_HI_CTX, "Hello")
+
+        assert llm._cached_reply(ChatContext(items=list(_HI_CTX.items))) == "Hello"
+
+        llm.clear_cache()
+        assert llm._cached_reply(_HI_CTX) is None
+
+    async def test_response_cache_skips_webhook_on_hit(self, mock_webhook_url):
+        """Test that chat() answers a repeated history without a second POST"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token", cache_ttl=60.0)
+
+        with aioresponses() as mocked:
+            mocked.post(mock_webhook_url, payload={"output": "Hello"}, repeat=True)
+
+            first = await drain_text(llm.chat(_HI_CTX))
+            second = await drain_text(llm.chat(ChatContext(items=list(_HI_CTX.items))))
+
+        assert first == second == "Hello"
+        mocked.assert_called_once()
+
+    def test_response_cache_misses_repeated_utterance(self, mock_webhook_url):
+        """Test that repeating the same words later in the call is not a hit"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token", cache_ttl=60.0)
+        first = ChatContext(items=[ChatMessage(role="user", content=["yes"])])
+        later = ChatContext(items=[
+            ChatMessage(role="user", content=["yes"]),
+            ChatMessage(role="assistant", content=["Shall I book it?"]),
+            ChatMessage(role="user", content=["yes"]),
+        ])
+
+        llm._store_reply(first, "Great")
+
+        assert llm._cached_reply(later) is None
+
+    def test_response_cache_skips_fallback_reply(self, mock_webhook_url):
+        """Test that the empty-reply fallback is never cached"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token", cache_ttl=60.0)
+
+        llm._store_reply(_HI_CTX, EMPTY_REPLY_TEXT)
+
+        assert llm._cached_reply(_HI_CTX) is None
+
+    def test_response_cache_expires(self, mock_webhook_url):
+        """Test that entries older than cache_ttl are not served"""
+        llm = N8nWebhookLLM(mock_webhook_url, "token", cache_ttl=60.0)
+
+        with patch("n8n_agent.time.monotonic", return_value=0.0):
+            llm._store_reply(_HI_CTX, "Hello")
+        with patch("n8n_agent.time.monotonic", return_value=61.0):
+            assert llm._cached_reply(_HI_CTX) is None